@@ -1,6 +1,7 @@
 package handler
 
 import (
+	"bytes"
 	"encoding/json"
 	"errors"
 	"fmt"
@@ -176,6 +177,30 @@ func (h *APIHandler) InternalObservationHandler(w http.ResponseWriter, r *http.R
 	h.logger.Debug("Received raw internal observation body", "sandboxID", sandboxID, "body", string(bodyBytes))
 	// ***************************
 
+	// The agent coalesces observations that queue up while a previous POST is in
+	// flight into one newline-delimited JSON body; process each line in order.
+	if strings.HasPrefix(r.Header.Get("Content-Type"), "application/x-ndjson") {
+		var firstErr error
+		for _, line := range bytes.Split(bodyBytes, []byte("\n")) {
+			line = bytes.TrimSpace(line)
+			if len(line) == 0 {
+				continue
+			}
+			if err := h.sandboxManager.ReceiveInternalObservation(sandboxID, line); err != nil {
+				h.logger.Error("Failed to process internal observation", "sandboxID", sandboxID, "error", err)
+				if firstErr == nil {
+					firstErr = err
+				}
+			}
+		}
+		if firstErr != nil {
+			WriteError(w, "Failed to process observation: "+firstErr.Error(), http.StatusInternalServerError)
+			return
+		}
+		w.WriteHeader(http.StatusOK)
+		return
+	}
+
 	// Pass the raw bytes to the manager for processing and broadcasting
 	err = h.sandboxManager.ReceiveInternalObservation(sandboxID, bodyBytes)
 	if err != nil {
@@ -93,18 +93,24 @@ func TestClientV1(t *testing.T) {
 	require.NoError(t, json.Unmarshal(shellCasesJSON, &shellCases))
 	require.GreaterOrEqual(t, len(shellCases), 1, "shell cases should not be empty")
 
-	for _, tc := range shellCases {
-		t.Run(tc.Name, func(t *testing.T) {
-			resp, err := c.RunShellCommand(ctx, space, createdSbx.Name, &v1.RunShellCommandRequest{
-				Command:     tc.Command,
-				SplitOutput: tc.Split,
+	// Shell commands don't share state, so the cases run in parallel. The
+	// enclosing group returns only once every parallel subtest has finished,
+	// which keeps them ahead of the sandbox cleanup.
+	t.Run("shell", func(t *testing.T) {
+		for _, tc := range shellCases {
+			t.Run(tc.Name, func(t *testing.T) {
+				t.Parallel()
+				resp, err := c.RunShellCommand(ctx, space, createdSbx.Name, &v1.RunShellCommandRequest{
+					Command:     tc.Command,
+					SplitOutput: tc.Split,
+				})
+				require.NoError(t, err, "Running shell command")
+				require.Equal(t, tc.ExpectedOutput, resp.Output, "output")
+				require.Equal(t, tc.ExpectedStdout, resp.Stdout, "stdout")
+				require.Equal(t, tc.ExpectedStderr, resp.Stderr, "stderr")
 			})
-			require.NoError(t, err, "Running shell command")
-			require.Equal(t, tc.ExpectedOutput, resp.Output, "output")
-			require.Equal(t, tc.ExpectedStdout, resp.Stdout, "stdout")
-			require.Equal(t, tc.ExpectedStderr, resp.Stderr, "stderr")
-		})
-	}
+		}
+	})
 }
 
 func TestClientV1NoOptions(t *testing.T) {
@@ -1,6 +1,6 @@
 # mentis_client/models.py
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, List, Any, Literal, Union
+from typing import Optional, Dict, List, Any, Literal, Type, Union
 from datetime import datetime
 import logging
 
@@ -81,91 +81,56 @@ StreamMessage = Union[
     # Add future Observation types here
 ]
 
+# Model for each observation_type, built once at import; the runtime's short
+# names ('stream', 'start', 'result', 'end') map onto the IPython models
+_OBSERVATION_MODELS: Dict[str, Type[BaseObservation]] = {
+    "stream": IPythonOutputObservationPart,
+    "start": IPythonStartObservation,
+    "end": IPythonResultObservation,
+    "result": IPythonResultObservation,
+    "CmdStartObservation": CmdStartObservation,
+    "CmdOutputObservationPart": CmdOutputObservationPart,
+    "CmdEndObservation": CmdEndObservation,
+    "IPythonStartObservation": IPythonStartObservation,
+    "IPythonOutputObservationPart": IPythonOutputObservationPart,
+    "IPythonResultObservation": IPythonResultObservation,
+    "ErrorObservation": ErrorObservation,
+    "AgentStateObservation": AgentStateObservation,
+}
+
 # Example parsing function (could be used in the callback)
 def parse_observation(data: Dict[str, Any]) -> BaseObservation:
     """Parses raw dict into specific Pydantic Observation model."""
-    # Pydantic v2 with discriminated unions handles this automatically if StreamMessage is annotated
-    # Manual way for Pydantic v1 or without unions:
     obs_type = data.get("observation_type")
-    
     # 记录原始action_id，用于调试
     original_action_id = data.get("action_id")
-    if original_action_id:
-        logger.debug(f"Processing observation with original action_id: {original_action_id}")
-    
-    # 创建数据副本，确保不修改原始数据
-    data_copy = data.copy()
-    
-    # 处理服务器发送的特殊类型观察数据
-    if obs_type == "stream":
-        # 将'line'字段复制到'data'字段，以便与IPythonOutputObservationPart兼容
-        if "line" in data_copy and "data" not in data_copy:
-            data_copy["data"] = data_copy["line"]
-        # 确保保留原始action_id
-        logger.debug(f"Converting 'stream' observation with action_id: {original_action_id}")
-        return IPythonOutputObservationPart(**data_copy)
-    
-    # 处理服务器发送的'start'类型观察数据
-    if obs_type == "start":
-        # 确保数据包含必要的字段
-        if "code" not in data_copy:
+    logger.debug("Processing %s observation with action_id: %s", obs_type, original_action_id)
+
+    model = _OBSERVATION_MODELS.get(obs_type) if isinstance(obs_type, str) else None
+    if model is not None:
+        # 处理服务器发送的特殊类型观察数据; copy only when a field has to be filled in,
+        # so the original data is never modified
+        if obs_type == "stream":
+            # 将'line'字段复制到'data'字段，以便与IPythonOutputObservationPart兼容
+            if "line" in data and "data" not in data:
+                data = {**data, "data": data["line"]}
+        elif obs_type == "start":
             # 如果没有code字段，添加一个空字符串
-            data_copy["code"] = ""
-        # 确保保留原始action_id
-        logger.debug(f"Converting 'start' observation with action_id: {original_action_id}")
-        return IPythonStartObservation(**data_copy)
-        
-    # 处理服务器发送的'end'类型观察数据
-    if obs_type == "end":
-        # 如果没有status字段，根据exit_code设置status
-        if "status" not in data_copy:
-            data_copy["status"] = "ok" if data_copy.get("exit_code", 0) == 0 else "error"
-        # 确保保留原始action_id
-        logger.debug(f"Converting 'end' observation with action_id: {original_action_id}")
-        return IPythonResultObservation(**data_copy)
-    
-    # 处理服务器发送的'result'类型观察数据
-    if obs_type == "result":
-        # 如果没有status字段，根据exit_code设置status
-        if "status" not in data_copy:
-            data_copy["status"] = "ok" if data_copy.get("exit_code", 0) == 0 else "error"
-        # 确保保留原始action_id
-        logger.debug(f"Converting 'result' observation with action_id: {original_action_id}")
-        return IPythonResultObservation(**data_copy)
-    
-    # 处理标准观察类型
-    if obs_type == "CmdStartObservation":
-        logger.debug(f"Processing CmdStartObservation with action_id: {original_action_id}")
-        return CmdStartObservation(**data_copy)
-    elif obs_type == "CmdOutputObservationPart":
-        logger.debug(f"Processing CmdOutputObservationPart with action_id: {original_action_id}")
-        return CmdOutputObservationPart(**data_copy)
-    elif obs_type == "CmdEndObservation":
-        logger.debug(f"Processing CmdEndObservation with action_id: {original_action_id}")
-        return CmdEndObservation(**data_copy)
-    elif obs_type == "IPythonStartObservation":
-        logger.debug(f"Processing IPythonStartObservation with action_id: {original_action_id}")
-        return IPythonStartObservation(**data_copy)
-    elif obs_type == "IPythonOutputObservationPart":
-        logger.debug(f"Processing IPythonOutputObservationPart with action_id: {original_action_id}")
-        return IPythonOutputObservationPart(**data_copy)
-    elif obs_type == "IPythonResultObservation":
-        logger.debug(f"Processing IPythonResultObservation with action_id: {original_action_id}")
-        return IPythonResultObservation(**data_copy)
-    elif obs_type == "ErrorObservation":
-        logger.debug(f"Processing ErrorObservation with action_id: {original_action_id}")
-        return ErrorObservation(**data_copy)
-    elif obs_type == "AgentStateObservation":
-        logger.debug(f"Processing AgentStateObservation with action_id: {original_action_id}")
-        return AgentStateObservation(**data_copy)
-    else:
-        # Fallback or raise error for unknown types
-        logger.warning(f"Received unknown observation type: {obs_type} with action_id: {original_action_id}")
-        # Return BaseObservation or a custom UnknownObservation type
-        # This might fail if fields don't match base, consider a dedicated UnknownObservation model
-        try:
-            return BaseObservation(**data_copy)
-        except Exception:
-             logger.error(f"Failed to parse unknown observation type {obs_type} with action_id: {original_action_id} as BaseObservation.", exc_info=True)
-             # Return a minimal representation or raise an error
-             return BaseObservation(observation_type=obs_type or "Unknown", action_id=original_action_id, timestamp=datetime.now()) # Example fallback
+            if "code" not in data:
+                data = {**data, "code": ""}
+        elif obs_type in ("end", "result"):
+            # 如果没有status字段，根据exit_code设置status
+            if "status" not in data:
+                data = {**data, "status": "ok" if data.get("exit_code", 0) == 0 else "error"}
+        return model.model_validate(data)
+
+    # Fallback or raise error for unknown types
+    logger.warning("Received unknown observation type: %s with action_id: %s", obs_type, original_action_id)
+    # Return BaseObservation or a custom UnknownObservation type
+    # This might fail if fields don't match base, consider a dedicated UnknownObservation model
+    try:
+        return BaseObservation.model_validate(data)
+    except Exception:
+         logger.error("Failed to parse unknown observation type %s with action_id: %s as BaseObservation.", obs_type, original_action_id, exc_info=True)
+         # Return a minimal representation or raise an error
+         return BaseObservation(observation_type=obs_type or "Unknown", action_id=original_action_id, timestamp=datetime.now()) # Example fallback
@@ -49,11 +49,13 @@ class SpaceManager:
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
             
+        # One pooled client per manager; keep-alive connections are reused across calls
         return httpx.Client(
             base_url=self.base_url,
             headers=headers,
             timeout=30.0,
-            follow_redirects=True
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16)
         )
         
     def _handle_response(self, response: httpx.Response) -> Any:
@@ -4,7 +4,8 @@ import pytest
 import time
 import queue
 import logging
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from mentis_client.client import MentisSandbox
 from mentis_client.embedded import EmbeddedMentisSandbox
@@ -39,17 +40,21 @@ except ImportError:
 from mentis_client.spaces import SpaceManager, CreateSpaceRequest
 
 # Configure logging for the test file
-# Set level to DEBUG for verbose output during testing
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Set level to DEBUG for verbose output during testing (override with MENTIS_TEST_LOG_LEVEL)
+logging.basicConfig(level=os.environ.get("MENTIS_TEST_LOG_LEVEL", "DEBUG").upper(), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__) # Logger for this test module
+# Checked once so the per-observation loops below skip log formatting entirely when not debugging
+DEBUG = logger.isEnabledFor(logging.DEBUG)
+
+# Every test here talks to a running runtime; unit-only runs can skip them with -m "not e2e"
+pytestmark = pytest.mark.e2e
 
 # Test configuration
 BASE_URL = os.environ.get("MENTIS_RUNTIME_URL", "http://localhost:5266") # Ensure this points to your Go Runtime
 TEST_TIMEOUT = 30.0  # Default timeout for collecting observations
 
 # --- Fixtures ---
-@pytest.fixture(scope="function")
-def sandbox_session() -> Tuple[MentisSandbox, queue.Queue]:
+def _sandbox_session() -> Iterator[Tuple[MentisSandbox, queue.Queue]]:
     """创建沙箱会话，自动清理"""
     obs_queue = queue.Queue()
     sandbox = None # Initialize sandbox to None
@@ -106,6 +111,21 @@ def sandbox_session() -> Tuple[MentisSandbox, queue.Queue]:
                 # pytest.fail(f"Sandbox teardown failed: {e}")
 
 
+@pytest.fixture(scope="function")
+def sandbox_session() -> Iterator[Tuple[MentisSandbox, queue.Queue]]:
+    """A fresh sandbox per test, for tests that change sandbox state or drain the queue concurrently"""
+    yield from _sandbox_session()
+
+
+@pytest.fixture(scope="module")
+def shared_sandbox_session() -> Iterator[Tuple[MentisSandbox, queue.Queue]]:
+    """
+    One sandbox for the whole module, for side-effect-free tests; observations
+    are told apart by action_id, so leftovers from earlier tests are ignored
+    """
+    yield from _sandbox_session()
+
+
 @pytest.fixture(scope="function")
 def embedded_sandbox_session() -> Tuple[MentisSandbox, queue.Queue]:
     """创建嵌入式沙箱会话，自动清理"""
@@ -156,6 +176,14 @@ def embedded_sandbox_session() -> Tuple[MentisSandbox, queue.Queue]:
         #     embedded_wrapper.shutdown()
 
 
+@pytest.fixture(scope="session")
+def space_manager() -> Iterator[SpaceManager]:
+    """Session-wide SpaceManager so every space API call reuses one connection pool"""
+    manager = SpaceManager(base_url=BASE_URL)
+    yield manager
+    manager.close()
+
+
 # --- NEW Observation Collection Helper ---
 def collect_observations_until_end(
     q: queue.Queue,
@@ -167,31 +195,37 @@ def collect_observations_until_end(
     until the 'end' observation is received or timeout occurs.
     """
     observations = []
-    start_time = time.time()
+    deadline = time.monotonic() + timeout
     logger.debug(f"Collecting observations for action_id: {action_id} (timeout={timeout}s)")
 
-    while time.time() - start_time < timeout:
+    while (remaining := deadline - time.monotonic()) > 0:
         try:
-            # Wait briefly for messages
-            obs: BaseObservation = q.get(timeout=0.5) # Increased timeout slightly per get
-            logger.debug(f"  Got observation: Type={obs.observation_type}, ActionID={getattr(obs, 'action_id', 'N/A')}") # Use getattr for safety
+            # Block on the queue, but never past the overall deadline
+            obs: BaseObservation = q.get(timeout=min(0.5, remaining))
+            # Look up each attribute once; getattr with a default is used for safety
+            obs_action_id = getattr(obs, 'action_id', None)
+            obs_type = getattr(obs, 'observation_type', None)
+            if DEBUG:
+                logger.debug("  Got observation: Type=%s, ActionID=%s", obs_type, obs_action_id)
 
             # Check if observation has an action_id and if it matches
-            obs_action_id = getattr(obs, 'action_id', None)
             if obs_action_id == action_id:
                 observations.append(obs)
                 # Stop condition: received the 'end' signal for this action
-                if getattr(obs, 'observation_type', None) == "end":
-                    logger.debug(f"  'end' observation received for action {action_id}. Collection complete.")
+                if obs_type == "end":
+                    if DEBUG:
+                        logger.debug("  'end' observation received for action %s. Collection complete.", action_id)
                     return observations
-            elif obs_action_id is not None:
-                 logger.debug(f"  Ignoring observation for different action_id: {obs_action_id}")
-            else:
-                 logger.debug(f"  Ignoring observation without action_id: Type={getattr(obs, 'observation_type', 'N/A')}")
+            elif DEBUG:
+                if obs_action_id is not None:
+                    logger.debug("  Ignoring observation for different action_id: %s", obs_action_id)
+                else:
+                    logger.debug("  Ignoring observation without action_id: Type=%s", obs_type)
 
         except queue.Empty:
             # No message in this poll interval, continue waiting
-            logger.debug(f"  Queue empty, continuing wait for action {action_id}...")
+            if DEBUG:
+                logger.debug("  Queue empty, continuing wait for action %s...", action_id)
             continue
         except Exception as e:
              logger.error(f"  Unexpected error getting from observation queue: {e}", exc_info=True)
@@ -208,70 +242,81 @@ def collect_observations_until_end(
     return observations
 
 
+def group_by_type(observations: List[BaseObservation]) -> Dict[str, List[BaseObservation]]:
+    """Groups observations by observation_type in one pass, keeping their order"""
+    by_type: Dict[str, List[BaseObservation]] = {}
+    for obs in observations:
+        by_type.setdefault(getattr(obs, 'observation_type', ''), []).append(obs)
+    return by_type
+
+
+def iter_stream_lines(by_type: Dict[str, List[BaseObservation]], stream: str = "stdout"):
+    """Lazily yields the text of every 'stream' observation for the given stream"""
+    for obs in by_type.get("stream", ()):
+        if getattr(obs, 'stream', None) == stream:
+            yield getattr(obs, 'line', None) or ''
+
+
+def find_observation(by_type: Dict[str, List[BaseObservation]], observation_type: str) -> Optional[BaseObservation]:
+    """Returns the first observation of the given type, or None"""
+    matches = by_type.get(observation_type)
+    return matches[0] if matches else None
+
+
 # --- Tests ---
 
-def test_basic_ipython_execution(sandbox_session):
+def test_basic_ipython_execution(shared_sandbox_session):
     """测试基本的 IPython 代码执行"""
-    sandbox, obs_queue = sandbox_session
+    sandbox, obs_queue = shared_sandbox_session
     code = "print('Hello, World!')\n1 + 1"
     logger.info(f"Running test_basic_ipython_execution with code: {code}")
     action_id = sandbox.run_ipython_cell(code)
     logger.info(f"Action ID: {action_id}")
 
     # Use the new helper function waiting for 'end'
-    observations = collect_observations_until_end(obs_queue, action_id)
+    observations = group_by_type(collect_observations_until_end(obs_queue, action_id))
 
-    stdout = ""
-    result_obs = None
-    for obs in observations:
-        if getattr(obs, 'observation_type', None) == "stream" and getattr(obs, 'stream', None) == "stdout":
-            stdout += getattr(obs, 'line', '')
-        if getattr(obs, 'observation_type', None) == "result":
-            result_obs = obs
+    result_obs = find_observation(observations, "result")
 
-    logger.debug(f"Collected Stdout:\n{stdout}")
-    logger.debug(f"Result Observation: {result_obs}")
+    if DEBUG:
+        logger.debug("Collected Stdout:\n%s", "".join(iter_stream_lines(observations)))
+        logger.debug("Result Observation: %s", result_obs)
 
-    assert "Hello, World!" in stdout, "Expected output not found in stdout"
+    # Short-circuits on the first matching line instead of concatenating all output
+    assert any("Hello, World!" in line for line in iter_stream_lines(observations)), "Expected output not found in stdout"
     # Check the result observation exists and indicates success
     assert result_obs is not None, "Did not receive 'result' observation"
     assert getattr(result_obs, 'exit_code', None) == 0, f"Expected exit_code 0, got {getattr(result_obs, 'exit_code', None)}"
     # Optionally check the actual result output if needed/available
     # assert "Out[...]: 2" in stdout # Note: IPython Out prompt number varies
 
-def test_basic_shell_execution(sandbox_session):
+def test_basic_shell_execution(shared_sandbox_session):
     """测试基本的 Shell 命令执行"""
-    sandbox, obs_queue = sandbox_session
+    sandbox, obs_queue = shared_sandbox_session
     command = "echo 'Hello from Shell' && pwd"
     logger.info(f"Running test_basic_shell_execution with command: {command}")
     action_id = sandbox.run_shell_command(command)
     logger.info(f"Action ID: {action_id}")
 
     # Use the new helper function waiting for 'end'
-    observations = collect_observations_until_end(obs_queue, action_id)
+    observations = group_by_type(collect_observations_until_end(obs_queue, action_id))
 
-    stdout = ""
-    result_obs = None
-    for obs in observations:
-        if getattr(obs, 'observation_type', None) == "stream" and getattr(obs, 'stream', None) == "stdout":
-            stdout += getattr(obs, 'line', '') + "\n" # Add newline as lines are sent separately
-        if getattr(obs, 'observation_type', None) == "result":
-            result_obs = obs
-
-    # Strip trailing newline from concatenation
-    stdout = stdout.strip()
+    result_obs = find_observation(observations, "result")
 
-    logger.debug(f"Collected Stdout:\n{stdout}")
-    logger.debug(f"Result Observation: {result_obs}")
+    if DEBUG:
+        # Lines are sent separately, so join them with newlines for display
+        logger.debug("Collected Stdout:\n%s", "\n".join(iter_stream_lines(observations)))
+        logger.debug("Result Observation: %s", result_obs)
 
-    assert "Hello from Shell" in stdout, "Expected output 'Hello from Shell' not found"
-    assert "/work" in stdout, f"Expected '/work' (working directory) not found in stdout: {stdout}"
+    assert any("Hello from Shell" in line for line in iter_stream_lines(observations)), "Expected output 'Hello from Shell' not found"
+    assert any("/work" in line for line in iter_stream_lines(observations)), \
+        f"Expected '/work' (working directory) not found in stdout: {list(iter_stream_lines(observations))}"
     assert result_obs is not None, "Did not receive 'result' observation"
     assert getattr(result_obs, 'exit_code', None) == 0, f"Expected exit_code 0, got {getattr(result_obs, 'exit_code', None)}"
 
-def test_error_handling(sandbox_session):
+def test_error_handling(shared_sandbox_session):
     """测试错误处理"""
-    sandbox, obs_queue = sandbox_session
+    sandbox, obs_queue = shared_sandbox_session
     code = "1/0" # Code designed to raise ZeroDivisionError
     logger.info(f"Running test_error_handling with code: {code}")
     action_id = sandbox.run_ipython_cell(code)
@@ -279,30 +324,17 @@ def test_error_handling(sandbox_session):
 
     # Use the new helper function waiting for 'end'
     # We expect 'result' and 'end' even on error
-    observations = collect_observations_until_end(obs_queue, action_id)
+    observations = group_by_type(collect_observations_until_end(obs_queue, action_id))
 
-    stderr_content = "" # Collect stderr just in case, though IPython errors often go to stdout stream
-    stdout_content = ""
-    result_obs = None
-    end_obs = None
-
-    for obs in observations:
-        logger.debug(f"  Processing observation: Type={obs.observation_type}, ActionID={getattr(obs, 'action_id', 'N/A')}")
-        if getattr(obs, 'observation_type', None) == "stream":
-             stream_type = getattr(obs, 'stream', None)
-             line_content = getattr(obs, 'line', '')
-             logger.debug(f"    Stream Type: {stream_type}, Line: '{line_content.strip()}'")
-             if stream_type == 'stderr':
-                 stderr_content += line_content + "\n"
-             elif stream_type == 'stdout': # IPython errors might be here
-                 stdout_content += line_content + "\n"
-        elif getattr(obs, 'observation_type', None) == "result":
-             result_obs = obs
-             logger.debug(f"    Result Obs: exit_code={getattr(obs, 'exit_code', 'N/A')}, error='{getattr(obs, 'error', 'N/A')}'")
-        elif getattr(obs, 'observation_type', None) == "end":
-             end_obs = obs
-             logger.debug(f"    End Obs: exit_code={getattr(obs, 'exit_code', 'N/A')}, error='{getattr(obs, 'error', 'N/A')}'")
+    result_obs = find_observation(observations, "result")
+    end_obs = find_observation(observations, "end")
 
+    if DEBUG:
+        # IPython errors usually go to the stdout stream; stderr is logged just in case
+        logger.debug("Collected Stdout:\n%s", "".join(iter_stream_lines(observations)))
+        logger.debug("Collected Stderr:\n%s", "".join(iter_stream_lines(observations, "stderr")))
+        logger.debug("Result Observation: %s", result_obs)
+        logger.debug("End Observation: %s", end_obs)
 
     # Assertions
     assert result_obs is not None, "Did not receive 'result' observation"
@@ -326,8 +358,8 @@ def test_error_handling(sandbox_session):
     # --- END 替换逻辑 ---
 
     # Optional: Check if traceback appeared in stdout stream (as IPython often does)
-    assert "ZeroDivisionError" in stdout_content or "division by zero" in stdout_content, \
-        f"Did not find error details in stdout stream capture:\n{stdout_content}"
+    assert any("ZeroDivisionError" in line or "division by zero" in line for line in iter_stream_lines(observations)), \
+        "Did not find error details in stdout stream capture:\n" + "".join(iter_stream_lines(observations))
 
 
 def test_embedded_mode(embedded_sandbox_session):
@@ -340,29 +372,23 @@ def test_embedded_mode(embedded_sandbox_session):
     logger.info(f"Action ID: {action_id}")
 
     # Use the new helper function waiting for 'end'
-    observations = collect_observations_until_end(obs_queue, action_id)
+    observations = group_by_type(collect_observations_until_end(obs_queue, action_id))
 
-    stdout = ""
-    result_obs = None
-    for obs in observations:
-        if getattr(obs, 'observation_type', None) == "stream" and getattr(obs, 'stream', None) == "stdout":
-            stdout += getattr(obs, 'line', '')
-        if getattr(obs, 'observation_type', None) == "result":
-            result_obs = obs
+    result_obs = find_observation(observations, "result")
 
-    logger.debug(f"Collected Stdout:\n{stdout}")
-    logger.debug(f"Result Observation: {result_obs}")
+    if DEBUG:
+        logger.debug("Collected Stdout:\n%s", "".join(iter_stream_lines(observations)))
+        logger.debug("Result Observation: %s", result_obs)
 
-    assert "Hello from Embedded Mode" in stdout
+    assert any("Hello from Embedded Mode" in line for line in iter_stream_lines(observations))
     assert result_obs is not None, "Did not receive 'result' observation"
     assert getattr(result_obs, 'exit_code', None) == 0, f"Expected exit_code 0, got {getattr(result_obs, 'exit_code', None)}"
 
-def test_space_management():
+def test_space_management(space_manager):
     """测试 Space 管理功能 (依赖服务器实现)"""
     logger.info("Running test_space_management...")
     # NOTE: This test assumes the BASE_URL server implements the /spaces endpoints.
     # If the server doesn't implement these, this test will fail (e.g., 404 Not Found).
-    space_manager = SpaceManager(base_url=BASE_URL)
     space_name = f"test-space-{int(time.time())}"
     space = None # Initialize
     logger.info(f"Attempting to create space: {space_name}")
@@ -373,13 +399,17 @@ def test_space_management():
         assert space.name == space_name
         assert space.description == "E2E test space"
 
-        logger.info(f"Attempting to retrieve space: {space.space_id}")
-        retrieved_space = space_manager.get_space(space.space_id)
+        # get and list are independent reads, so issue them concurrently
+        logger.info(f"Attempting to retrieve space {space.space_id} and list spaces...")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            get_future = pool.submit(space_manager.get_space, space.space_id)
+            list_future = pool.submit(space_manager.list_spaces)
+            retrieved_space = get_future.result()
+            spaces = list_future.result()
+
         assert retrieved_space.name == space_name
         assert retrieved_space.space_id == space.space_id
 
-        logger.info("Attempting to list spaces...")
-        spaces = space_manager.list_spaces()
         assert any(s.space_id == space.space_id and s.name == space_name for s in spaces), \
             f"Newly created space {space_name} not found in list"
         logger.info("Space management basic checks passed.")
@@ -416,22 +446,26 @@ class ConcurrentTask:
     def collect_results(self, obs_queue: queue.Queue, timeout: float = TEST_TIMEOUT):
         """收集任务结果, 等待 'end' 观察结果"""
         observations: List[BaseObservation] = []
-        start_time = time.time()
+        deadline = time.monotonic() + timeout
         self.logger.debug(f"Task {self.task_id} starting observation collection for action {self.action_id} (Timeout: {timeout}s)")
-        while time.time() - start_time < timeout:
+        while (remaining := deadline - time.monotonic()) > 0:
             try:
-                obs = obs_queue.get(timeout=0.2)
+                obs = obs_queue.get(timeout=min(0.5, remaining))
                 obs_action_id = getattr(obs, 'action_id', None)
                 if obs_action_id == self.action_id:
-                    self.logger.debug(f"Task {self.task_id} received relevant observation: {getattr(obs, 'observation_type', 'N/A')}")
+                    obs_type = getattr(obs, 'observation_type', None)
+                    if DEBUG:
+                        self.logger.debug("Task %s received relevant observation: %s", self.task_id, obs_type)
                     observations.append(obs)
-                    if getattr(obs, 'observation_type', None) == "end":
-                        self.logger.debug(f"Task {self.task_id} received 'end' observation for action {self.action_id}. Collection complete.")
+                    if obs_type == "end":
+                        if DEBUG:
+                            self.logger.debug("Task %s received 'end' observation for action %s. Collection complete.", self.task_id, self.action_id)
                         return observations
-                elif obs_action_id is not None:
-                     self.logger.debug(f"Task {self.task_id} received observation for *different* action {obs_action_id}. Ignoring.")
+                elif DEBUG and obs_action_id is not None:
+                     self.logger.debug("Task %s received observation for *different* action %s. Ignoring.", self.task_id, obs_action_id)
             except queue.Empty:
-                self.logger.debug(f"Task {self.task_id} queue empty, continuing wait...")
+                if DEBUG:
+                    self.logger.debug("Task %s queue empty, continuing wait...", self.task_id)
                 continue
         self.logger.warning(f"Timeout ({timeout}s) waiting for 'end' observation for action {self.action_id}. Returning {len(observations)} partial results collected.")
         return observations
@@ -478,15 +512,17 @@ def test_shell_concurrent_execution(sandbox_session):
         for obs in observations:
             # (可选) 打印原始观测数据
             # print(f"Task {i} Raw Obs - Type: {getattr(obs, 'observation_type', 'N/A')}...")
-            if getattr(obs, 'observation_type', None) == "stream":
-                if getattr(obs, 'stream', None) == "stdout":
+            obs_type = getattr(obs, 'observation_type', None)
+            if obs_type == "stream":
+                stream = getattr(obs, 'stream', None)
+                if stream == "stdout":
                     # Shell 命令输出的 line 可能不带换行，如果需要按行处理需添加
                     stdout += getattr(obs, 'line', '') + "\n"
-                elif getattr(obs, 'stream', None) == "stderr":
+                elif stream == "stderr":
                      stderr += getattr(obs, 'line', '') + "\n"
-            elif getattr(obs, 'observation_type', None) == "result":
+            elif obs_type == "result":
                  result_exit_code = getattr(obs, 'exit_code', None)
-            elif getattr(obs, 'observation_type', None) == "end":
+            elif obs_type == "end":
                  end_obs_found = True
                  # end 观测也可能携带最终 exit_code
                  if result_exit_code is None:
@@ -565,13 +601,16 @@ print(f'Task {i} finished sleep')
         result_exit_code = None
 
         for obs in observations:
-             print(f"Task {i} Raw Obs - Type: {getattr(obs, 'observation_type', 'N/A')}, Stream: {getattr(obs, 'stream', 'N/A')}, Content: {getattr(obs, 'line', getattr(obs, 'status', 'N/A'))}") # Raw log
-             if getattr(obs, 'observation_type', None) == "stream":
-                 if getattr(obs, 'stream', None) == "stdout":
+             obs_type = getattr(obs, 'observation_type', None)
+             stream = getattr(obs, 'stream', None)
+             if DEBUG:
+                 print(f"Task {i} Raw Obs - Type: {obs_type}, Stream: {stream}, Content: {getattr(obs, 'line', getattr(obs, 'status', 'N/A'))}") # Raw log
+             if obs_type == "stream":
+                 if stream == "stdout":
                      stdout += getattr(obs, 'line', '') + "\n" # Add newline
-                 elif getattr(obs, 'stream', None) == "stderr":
+                 elif stream == "stderr":
                       stderr += getattr(obs, 'line', '') + "\n" # Add newline
-             elif getattr(obs, 'observation_type', None) == "result":
+             elif obs_type == "result":
                   result_exit_code = getattr(obs, 'exit_code', None)
 
         results[i] = {"stdout": stdout.strip(), "stderr": stderr.strip(), "exit_code": result_exit_code, "obs_count": len(observations)}
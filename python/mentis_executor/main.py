@@ -1,18 +1,39 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from IPython.core.interactiveshell import InteractiveShell
-from contextlib import redirect_stdout, redirect_stderr
-import json
-import threading
+from pydantic import BaseModel, ValidationError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, redirect_stdout, redirect_stderr
+import asyncio
+import orjson
 import collections
-import subprocess
+import importlib
 import io
 import os
-import requests
+import signal
+import sys
+import threading
+import httpx
 import logging
 import traceback # Import traceback
+from typing import Any, Optional, TypeVar
 from datetime import datetime, timezone # Added for timestamp
 
+# Logging is configured once, only when run as a script, and before the
+# import-time setup below logs anything; when imported as a library the host
+# application decides where (and whether) these records go
+logger = logging.getLogger("mentis-executor")
+logger.addHandler(logging.NullHandler())
+if __name__ == "__main__":
+    LOG_LEVEL = os.environ.get("MENTIS_EXECUTOR_LOG_LEVEL", "info").lower() # Allow configuring log level
+    logging.basicConfig(level=LOG_LEVEL.upper(), # Set level based on env var
+                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(LOG_LEVEL.upper())
+    # httpx logs every observation POST at INFO; keep that for debugging only
+    if LOG_LEVEL != "debug":
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # Import Pydantic models from sandboxai library if possible,
 # otherwise define minimal ones here if needed for request validation/typing.
 # Assuming they are accessible via sandboxai.api.v1 as before
@@ -25,39 +46,126 @@ try:
     )
 except ImportError:
     # Define minimal Pydantic models if import fails (basic structure)
-    from pydantic import BaseModel, Field
-    from typing import Optional
     logger.warning("Could not import Pydantic models from sandboxai.api.v1, using fallback definitions.")
 
-    class RunIPythonCellRequest(BaseModel):
+    class RunIPythonCellRequest(BaseModel): # type: ignore[no-redef]
         code: str
         split_output: Optional[bool] = False
         action_id: Optional[str] = None
 
-    class RunShellCommandRequest(BaseModel):
+    class RunShellCommandRequest(BaseModel): # type: ignore[no-redef]
         command: str
         split_output: Optional[bool] = False
         action_id: Optional[str] = None
 
 
-# Configure logging
-# Ensure level is DEBUG to see the new logs
-logging.basicConfig(level=logging.DEBUG, # <-- Set level to DEBUG
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger("mentis-executor")
+_Body = TypeVar("_Body", bound=BaseModel)
+
+
+async def _parse_body(http_request: Request, model: type[_Body]) -> _Body:
+    """
+    Parses and validates the raw JSON body in one pydantic-core pass, instead
+    of FastAPI decoding it to a dict first and validating that. Invalid bodies
+    still get the usual 422.
+    """
+    try:
+        return model.model_validate_json(await http_request.body())
+    except ValidationError as e:
+        # Same "body"-rooted locations FastAPI reports for a declared body param
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
+
+
+def _body_schema(model: type[BaseModel]) -> dict[str, Any]:
+    # Routes take the raw Request, so document the body explicitly
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": model.model_json_schema()}}}}
+
+
+# The runtime injects these into the container environment; they do not change
+# for the lifetime of the process, so read them once at import
+SANDBOX_ID = os.environ.get('SANDBOX_ID', '')
+RUNTIME_OBSERVATION_URL = os.environ.get('RUNTIME_OBSERVATION_URL')
+
+# Dedicated pool for the blocking handler bodies, independent of Starlette's
+# default 40-thread pool
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("MENTIS_MAX_WORKERS", 64)),
+    thread_name_prefix="mentis-executor",
+)
+
+# 全局锁：每个 executor 只服务一个 sandbox (SANDBOX_ID)，一个锁即可串行化它的所有 IPython cell
+# An asyncio lock, only touched from the event loop, so waiting cells hold no
+# EXECUTOR thread
+ipython_lock = asyncio.Lock()
+
+
+# Observation drain tasks still running after their handler returned, and how
+# long shutdown waits for them (seconds)
+_background_tasks: set[asyncio.Task] = set()
+SHUTDOWN_DRAIN_TIMEOUT = 10.0
+
+# Comma-separated modules imported at startup so the first cell using them
+# does not pay the import cost
+PRELOAD_MODULES = [m.strip() for m in os.environ.get("MENTIS_PRELOAD_MODULES", "numpy").split(",") if m.strip()]
+
+
+def _warm_up() -> None:
+    """
+    Pays IPython's first-cell cost and the preload imports before the first
+    request. The cell is silent, so it neither shows up in the history nor
+    advances the execution count; modules are only cached in sys.modules,
+    not bound in the user namespace.
+    """
+    if ipy is not None:
+        ipy.run_cell("pass", silent=True)
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning("[AGENT] Could not preload module %s: %s", name, e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The runtime always injects the sandbox id, and every request is logged
+    # under it; a missing id means a misconfigured container, so refuse to start
+    if not SANDBOX_ID:
+        logger.error("SANDBOX_ID environment variable not set. Refusing to start.")
+        raise RuntimeError("Internal configuration error: SANDBOX_ID missing.")
+    # Executor threads hand observations to this loop, which posts them over one
+    # shared keep-alive client instead of a new connection per observation
+    app.state.loop = asyncio.get_running_loop()
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        # At most one in-flight POST per action, so this caps concurrent
+        # actions posting at once; idle sockets stay open for the next burst
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+    )
+    await app.state.loop.run_in_executor(EXECUTOR, _warm_up)
+    try:
+        yield
+    finally:
+        # Let in-flight observations reach the runtime before closing the
+        # client, but don't let a stuck drain hold up shutdown
+        if _background_tasks:
+            _, pending = await asyncio.wait(set(_background_tasks), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+            if pending:
+                logger.warning("[AGENT] Cancelling %d observation drain(s) still running at shutdown", len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        await app.state.http.aclose()
 
-# 全局锁字典，为每个 sandbox_id 存储一个独立的线程锁
-# defaultdict 会在首次访问不存在的 key 时自动创建 Lock 对象
-ipython_locks = collections.defaultdict(threading.Lock)
 # Initialize FastAPI app
 app = FastAPI(
     title="Mentis Sandbox Executor",
     version="1.0",
     description="The server that runs python code and shell commands in a MentisSandbox environment.",
+    lifespan=lifespan,
 )
 
 # Initialize IPython shell
 # Use a try-except block for robustness, especially in container environments
+ipy: Optional[InteractiveShell]
 try:
     # Suppress unnecessary IPython warnings if possible during init
     import warnings
@@ -67,16 +175,234 @@ try:
         ipy = InteractiveShell.instance(banner1='', exit_msg='')
     logger.info("IPython InteractiveShell initialized successfully.")
 except Exception as ipy_init_err:
-    logger.error(f"Failed to initialize IPython InteractiveShell: {ipy_init_err}", exc_info=True)
+    logger.error("Failed to initialize IPython InteractiveShell: %s", ipy_init_err, exc_info=True)
     ipy = None # Set ipy to None if initialization fails
 
+_UTC = timezone.utc
+
+def utc_timestamp() -> datetime:
+    """
+    Timestamp for observations. orjson encodes it as an RFC 3339 string, which
+    is what the runtime parses into a Go time.Time.
+    """
+    return datetime.now(_UTC)
+
+
+# Deepest frames kept in a result's traceback
+TRACEBACK_LIMIT = 20
+
+def compact_traceback(ex_type: type, ex_value: BaseException, tb: Any) -> list[str]:
+    """
+    Traceback lines for a result observation: one "File ..., line ..., in ..."
+    entry per frame (innermost TRACEBACK_LIMIT frames) plus the exception line.
+    Unlike traceback.format_exception, source lines are never read from disk;
+    the cell's own output already carries IPython's rendered traceback.
+    """
+    frames = traceback.StackSummary.extract(traceback.walk_tb(tb), limit=-TRACEBACK_LIMIT, lookup_lines=False)
+    lines = ["Traceback (most recent call last):"]
+    lines.extend(f'  File "{f.filename}", line {f.lineno}, in {f.name}' for f in frames)
+    lines.append(f"{ex_type.__name__}: {ex_value}")
+    return lines
+
+
+# Max observations waiting to be posted per action before producers block
+OBSERVATION_QUEUE_SIZE = 256
+# Flush a coalesced NDJSON batch once its encoded size reaches this many bytes
+MAX_BATCH_BYTES = 256 * 1024
+
+class ObservationDispatcher:
+    """
+    Forwards the observations of one action to the runtime.
+
+    send() and close() are called from EXECUTOR threads, asend() and aclose()
+    from coroutines on the event loop; the POSTs themselves run on the loop
+    through the shared AsyncClient, so a producer never waits on the network.
+    Each observation is encoded to JSON by its producer, and observations are
+    sent in submission order, so the final "result" stays last. At most
+    OBSERVATION_QUEUE_SIZE observations wait per action: a producer that
+    outpaces the runtime blocks on a free slot instead of growing memory.
+    A thread hands an observation over with call_soon_threadsafe and never
+    waits for the loop itself. Once the action is closed, later observations
+    are dropped: the runtime has already ended it.
+    """
+
+    def __init__(self, url: Optional[str], action_id: Optional[str] = None):
+        self.url = url
+        self.action_id = action_id
+        self._loop: asyncio.AbstractEventLoop = app.state.loop
+        # Each queued observation carries the slot it holds, released once drained
+        self._queue: Optional["asyncio.Queue[Optional[tuple[bytes, Any]]]"] = None
+        self._slots = threading.BoundedSemaphore(OBSERVATION_QUEUE_SIZE)
+        self._aslots = asyncio.Semaphore(OBSERVATION_QUEUE_SIZE)
+        self._closed = False
+
+    @staticmethod
+    def _encode(data: dict) -> bytes:
+        # Stamp at submission time, not when the drain task gets to it
+        if "timestamp" not in data:
+            data["timestamp"] = utc_timestamp()
+        return orjson.dumps(data)
+
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _drop_closed(self, data: dict) -> bool:
+        if self._closed:
+            logger.debug("[AGENT] Dropping %s observation after the end of action %s", data.get("observation_type"), self.action_id)
+        return self._closed
+
+    def send(self, data: dict) -> None:
+        if not self.url or self._drop_closed(data):
+            return
+        line = self._encode(data)
+        if self._on_loop():
+            # Output written from the loop thread itself while a cell has
+            # sys.stdout/stderr redirected (e.g. a warning): blocking here would
+            # stall the drain, so it is queued without taking a slot
+            self._start().put_nowait((line, None))
+            return
+        observations = self._start()
+        # Blocks only this worker thread, and only while every slot is taken
+        self._slots.acquire()
+        self._loop.call_soon_threadsafe(observations.put_nowait, (line, self._slots))
+
+    def close(self) -> None:
+        """Marks the end of the action; queued observations keep draining in the background."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._queue is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    async def asend(self, data: dict) -> None:
+        if not self.url or self._drop_closed(data):
+            return
+        line = self._encode(data)
+        observations = self._start()
+        await self._aslots.acquire()
+        observations.put_nowait((line, self._aslots))
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._queue is not None:
+            self._queue.put_nowait(None)
+
+    def _start(self) -> "asyncio.Queue[Optional[tuple[bytes, Any]]]":
+        """Returns the action's queue, starting its drain task on first use."""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            if self._on_loop():
+                self._loop.create_task(self._drain(self._queue))
+            else:
+                asyncio.run_coroutine_threadsafe(self._drain(self._queue), self._loop)
+        return self._queue
+
+    async def _drain(self, observations: "asyncio.Queue[Optional[tuple[bytes, Any]]]") -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        _background_tasks.add(task)
+        try:
+            done = False
+            while not done:
+                item = await observations.get()
+                if item is None:
+                    return
+                # Coalesce whatever queued up while the previous POST was in flight
+                line, slot = item
+                if slot is not None:
+                    slot.release()
+                batch = [line]
+                size = len(line)
+                while size < MAX_BATCH_BYTES and not observations.empty():
+                    item = observations.get_nowait()
+                    if item is None:
+                        done = True
+                        break
+                    line, slot = item
+                    if slot is not None:
+                        slot.release()
+                    batch.append(line)
+                    size += len(line)
+                await send_observations_async(self.url, self.action_id, batch)
+        finally:
+            _background_tasks.discard(task)
+
+
+class ObservationStream(io.TextIOBase):
+    """
+    Write-through text stream used as the stdout/stderr target of an IPython cell.
+
+    Complete lines are pushed to the runtime as "stream" observations while the
+    cell is still running; a trailing partial line is held until the next newline
+    or an explicit flush(). Only the pending partial line is kept in memory.
+    Once the cell is over, anything still holding the stream (a logging handler,
+    a thread) writes to the process's own stdout/stderr instead.
+    """
+
+    def __init__(self, name: str, dispatcher: ObservationDispatcher, action_id: Optional[str]):
+        super().__init__()
+        self.name = name
+        self.dispatcher = dispatcher
+        self.action_id = action_id
+        self.chars = 0 # Total characters written, for logging
+        self._pending: list[str] = []
+        self._closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def detach_action(self) -> None:
+        """Sends the pending partial line and stops forwarding to the action."""
+        self._emit()
+        self._closed = True
+
+    def write(self, s: str) -> int:
+        if not s:
+            return 0
+        if self._closed:
+            fallback = sys.__stdout__ if self.name == "stdout" else sys.__stderr__
+            return fallback.write(s) if fallback is not None else len(s)
+        self.chars += len(s)
+        newline_at = s.rfind("\n")
+        if newline_at == -1:
+            self._pending.append(s)
+        else:
+            self._pending.append(s[:newline_at + 1])
+            self._emit()
+            if newline_at + 1 < len(s):
+                self._pending.append(s[newline_at + 1:])
+        return len(s)
+
+    def flush(self) -> None:
+        if not self._closed:
+            self._emit()
+
+    def _emit(self) -> None:
+        if not self._pending:
+            return
+        chunk = "".join(self._pending)
+        self._pending.clear()
+        if self.action_id:
+            self.dispatcher.send({
+                "observation_type": "stream",
+                "action_id": self.action_id,
+                "stream": self.name,
+                "line": chunk
+            })
+
+
 @app.get(
     "/health",
     summary="Check the health of the API",
     response_model=None, # No response body for simple health check
     status_code=200,     # Explicitly set success status code
 )
-def health():
+def health() -> Response:
     # Optionally add checks here (e.g., is ipy initialized?)
     if ipy is None:
          # Return 503 Service Unavailable if IPython failed
@@ -86,181 +412,269 @@ def health():
     return Response(status_code=200)
 
 
-@app.post(
-    "/tools:run_ipython_cell",
-    summary="Invoke a cell in a stateful IPython (Jupyter) kernel",
-    response_description="NDJSON stream of observations (stdout, stderr, result)",
-    status_code=200, # Return 200 OK immediately
-)
-def run_ipython_cell(request: RunIPythonCellRequest): # 保持函数签名不变
+def _run_ipython_cell_sync(request: RunIPythonCellRequest) -> Response:
     """
     Execute code in an IPython kernel. Observations are pushed asynchronously.
-    IPython executions for the SAME sandbox_id are serialized by a lock.
+    The caller holds the sandbox's lock, so cells of one sandbox never overlap.
     """
-    # --- 获取 Sandbox ID ---
-    # 假设 sandbox_id 通过环境变量获取，和之前日志一致
-    sandbox_id = os.environ.get('SANDBOX_ID')
-    if not sandbox_id:
-        logger.error("SANDBOX_ID environment variable not set. Cannot acquire lock.")
-        raise HTTPException(status_code=500, detail="Internal configuration error: SANDBOX_ID missing.")
-
     action_id = request.action_id # 从请求中获取 action_id
-    runtime_observation_url = os.environ.get('RUNTIME_OBSERVATION_URL') # 获取观测 URL
-
-    logger.info(f"[AGENT] Received IPython cell request. ActionID: {action_id}, SandboxID: {sandbox_id}. Attempting to acquire lock...")
-
-    # --- 获取并使用特定于此 sandbox_id 的锁 ---
-    # defaultdict 会自动为新的 sandbox_id 创建 Lock
-    sandbox_lock = ipython_locks[sandbox_id]
+    runtime_observation_url = RUNTIME_OBSERVATION_URL # 获取观测 URL
 
-    with sandbox_lock: # --- 关键：代码块开始，同一 sandbox 的其他 IPython 请求会在此等待 ---
-        logger.info(f"[AGENT] Lock acquired for SandboxID: {sandbox_id}, ActionID: {action_id}. Processing request...")
+    # V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V
+    # --- 这里是你原来 run_ipython_cell 函数的核心逻辑 ---
+    # --- (包括检查 ipy 是否 None, try...except 块, ipy.run_cell, ---
+    # --- 处理 stdout/stderr, 发送所有相关的 send_observation 调用) ---
 
-        # V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V V
-        # --- 这里是你原来 run_ipython_cell 函数的核心逻辑 ---
-        # --- (包括检查 ipy 是否 None, try...except 块, ipy.run_cell, ---
-        # --- 处理 stdout/stderr, 发送所有相关的 send_observation 调用) ---
+    if ipy is None:
+        logger.error("IPython shell not initialized, cannot run cell.")
+        # 注意：在锁内部抛出异常通常是安全的，with 语句会确保锁被释放
+        raise HTTPException(status_code=503, detail="IPython shell not available")
+
+    if not (runtime_observation_url and action_id):
+        # Nothing could be forwarded anyway, so skip the capture machinery
+        logger.warning("[AGENT] Cannot send observations: URL missing or action_id missing. URL=%s, ActionID=%s", runtime_observation_url, action_id)
+        ipy.run_cell(request.code, store_history=True)
+        return Response(status_code=200)
 
-        if ipy is None:
-            logger.error("IPython shell not initialized, cannot run cell.")
-            # 注意：在锁内部抛出异常通常是安全的，with 语句会确保锁被释放
-            raise HTTPException(status_code=503, detail="IPython shell not available")
+    exit_code = 0
+    error_name = None
+    error_value = None
+    formatted_tb = []
+    dispatcher = ObservationDispatcher(runtime_observation_url, action_id)
 
-        exit_code = 0
-        error_name = None
-        error_value = None
-        formatted_tb = []
+    try:
+        # Cell output is forwarded as it is written instead of being
+        # buffered until the cell completes.
+        stdout_stream = ObservationStream("stdout", dispatcher, action_id)
+        stderr_stream = ObservationStream("stderr", dispatcher, action_id)
 
         try:
-            stdout_buf = io.StringIO()
-            stderr_buf = io.StringIO()
-
-            with redirect_stdout(stdout_buf), redirect_stderr(stderr_buf):
+            with redirect_stdout(stdout_stream), redirect_stderr(stderr_stream):
                 # 实际执行 IPython 代码
                 exec_result = ipy.run_cell(request.code, store_history=True)
-
-            stdout = stdout_buf.getvalue()
-            stderr = stderr_buf.getvalue()
-
-            logger.info(f"[AGENT] IPython execution finished inside lock. ActionID: {action_id}. Success: {exec_result.success}. Stdout: {len(stdout)} chars. Stderr: {len(stderr)} chars.")
-
-            # --- 发送观测数据的逻辑 (保持不变，但现在它在锁的保护下) ---
-            if runtime_observation_url and action_id:
-                # 发送 stdout stream
-                if stdout:
-                    send_observation(runtime_observation_url, {
-                        "observation_type": "stream",
-                        "action_id": action_id,
-                        "stream": "stdout",
-                        "line": stdout # 发送完整 stdout
-                    })
-
-                # 发送 stderr stream (IPython错误通常在stdout，但以防万一)
-                if stderr:
-                     send_observation(runtime_observation_url, {
-                        "observation_type": "stream",
-                        "action_id": action_id,
-                        "stream": "stderr",
-                        "line": stderr
-                    })
-
-                # 发送 result 观测
-                if exec_result.error_before_exec or exec_result.error_in_exec:
-                   # (这里是你上次修改过的、提取 error_name/value/traceback 的逻辑)
-                    exit_code = 1
-                    error_info = exec_result.error_in_exec or exec_result.error_before_exec
-                    if error_info:
-                       try:
-                           ex_type, ex_value, tb = error_info
-                           error_name = ex_type.__name__
-                           error_value = str(ex_value)
-                           if hasattr(ipy, 'InteractiveTB') and hasattr(ipy.InteractiveTB, 'structured_traceback'):
-                                stb = ipy.InteractiveTB.structured_traceback(ex_type, ex_value, tb)
-                                formatted_tb = ipy.InteractiveTB.format_structured_traceback(stb)
-                           else:
-                                formatted_tb = traceback.format_exception(ex_type, ex_value, tb)
-                       except Exception as format_err:
-                           logger.error(f"[AGENT] Failed to extract/format IPython traceback info. ActionID: {action_id}. Error: {format_err}", exc_info=True)
-                           formatted_tb = ["Traceback formatting failed."]
-                           # 简化错误信息
-                           if error_info and isinstance(error_info, tuple) and len(error_info) >= 2:
-                               error_name = getattr(error_info[0], '__name__', 'UnknownError')
-                               error_value = str(error_info[1]) if error_info[1] else "Error value unavailable"
-                           else:
-                               error_name = "UnknownError"
-                               error_value = str(error_info)
-
-                    send_observation(runtime_observation_url, {
-                        "observation_type": "result",
-                        "action_id": action_id,
-                        "exit_code": exit_code,
-                        "status": "error",
-                        "error_name": error_name,
-                        "error_value": error_value,
-                        "traceback": formatted_tb,
-                    })
+        finally:
+            # 发送最后一段没有换行符的输出，然后与本次 action 断开
+            stdout_stream.detach_action()
+            stderr_stream.detach_action()
+
+        logger.info("[AGENT] IPython execution finished inside lock. ActionID: %s. Success: %s. Stdout: %s chars. Stderr: %s chars.", action_id, exec_result.success, stdout_stream.chars, stderr_stream.chars)
+
+        # --- 发送观测数据的逻辑 (保持不变，但现在它在锁的保护下) ---
+        # stdout/stderr stream 观测已由 ObservationStream 在执行过程中发送
+        # 发送 result 观测
+        # 只读取一次错误信息，后续分支都使用 err / has_err
+        err = exec_result.error_in_exec or exec_result.error_before_exec
+        has_err = err is not None
+        result: dict[str, Any] = {
+            "observation_type": "result",
+            "action_id": action_id,
+        }
+        if has_err:
+           # (这里是你上次修改过的、提取 error_name/value/traceback 的逻辑)
+            exit_code = 1
+            try:
+                # IPython 存储的是异常对象本身；旧版本可能是 (type, value, tb) 元组
+                if isinstance(err, BaseException):
+                    ex_type, ex_value, tb = type(err), err, err.__traceback__
                 else:
-                    exit_code = 0
-                    send_observation(runtime_observation_url, {
-                        "observation_type": "result",
-                        "action_id": action_id,
-                        "exit_code": exit_code,
-                        "status": "ok"
-                    })
-            else:
-                 logger.warning(f"[AGENT] Cannot send observations: URL missing or action_id missing. URL={runtime_observation_url}, ActionID={action_id}")
+                    ex_type, ex_value, tb = err
+                error_name = ex_type.__name__
+                error_value = str(ex_value)
+                # IPython's colorized structured traceback is slow to build; only
+                # pay for it when debugging, the plain stdlib format is enough otherwise
+                if logger.isEnabledFor(logging.DEBUG) and hasattr(ipy, 'InteractiveTB') and hasattr(ipy.InteractiveTB, 'structured_traceback'):
+                     formatted_tb = ipy.InteractiveTB.structured_traceback(ex_type, ex_value, tb)
+                else:
+                     formatted_tb = compact_traceback(ex_type, ex_value, tb)
+            except Exception as format_err:
+                logger.error("[AGENT] Failed to extract/format IPython traceback info. ActionID: %s. Error: %s", action_id, format_err, exc_info=True)
+                formatted_tb = ["Traceback formatting failed."]
+                # 简化错误信息
+                if isinstance(err, tuple) and len(err) >= 2:
+                    error_name = getattr(err[0], '__name__', 'UnknownError')
+                    error_value = str(err[1]) if err[1] else "Error value unavailable"
+                else:
+                    error_name = "UnknownError"
+                    error_value = str(err)
+
+            result.update({
+                "exit_code": exit_code,
+                "status": "error",
+                "error_name": error_name,
+                "error_value": error_value,
+                "traceback": formatted_tb,
+            })
+        else:
+            exit_code = 0
+            result.update({
+                "exit_code": exit_code,
+                "status": "ok"
+            })
+        # result 与 stream 观测走同一个队列，保证 result 是最后一个
+        dispatcher.send(result)
+        dispatcher.close()
+
+    except Exception as e:
+        # --- 处理核心逻辑中的意外错误 ---
+        exit_code = -1 # 或者其他表示内部错误的码
+        error_msg = f"Internal agent error during IPython execution: {e}"
+        tb_str = traceback.format_exc()
+        logger.error("[AGENT] %s. ActionID: %s\n%s", error_msg, action_id, tb_str)
+
+        # 发送一个表示错误的 'result' 或专门的 'error' 观测
+        dispatcher.send({
+            "observation_type": "result", # 或者 "error"
+            "action_id": action_id,
+            "exit_code": exit_code,
+            "status": "error", # 明确状态
+            "error_name": type(e).__name__,
+            "error_value": error_msg,
+            "traceback": tb_str.splitlines() # 发送 traceback 字符串列表
+        })
+        dispatcher.close()
+        # 在锁内部重新抛出为 HTTP 异常，FastAPI 会处理
+        raise HTTPException(status_code=500, detail=error_msg)
+
+    # --- 核心逻辑结束 ---
+    # A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A
 
-        except Exception as e:
-            # --- 处理核心逻辑中的意外错误 ---
-            exit_code = -1 # 或者其他表示内部错误的码
-            error_msg = f"Internal agent error during IPython execution: {e}"
-            tb_str = traceback.format_exc()
-            logger.error(f"[AGENT] {error_msg}. ActionID: {action_id}\n{tb_str}")
-
-            if runtime_observation_url and action_id:
-                 # 发送一个表示错误的 'result' 或专门的 'error' 观测
-                 send_observation(runtime_observation_url, {
-                     "observation_type": "result", # 或者 "error"
-                     "action_id": action_id,
-                     "exit_code": exit_code,
-                     "status": "error", # 明确状态
-                     "error_name": type(e).__name__,
-                     "error_value": error_msg,
-                     "traceback": tb_str.splitlines() # 发送 traceback 字符串列表
-                 })
-            # 在锁内部重新抛出为 HTTP 异常，FastAPI 会处理
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        # --- 核心逻辑结束 ---
-        # A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A A
-
-        logger.info(f"[AGENT] Releasing lock for SandboxID: {sandbox_id}, ActionID: {action_id}.")
-    # --- 关键：锁在这里自动释放 ---
-
-    # 注意：HTTP 响应应该在锁释放之后发送
     # Executor 的设计是异步发送观测，并立即返回 200 OK 给 Runtime
     return Response(status_code=200)
 
+
+@app.post(
+    "/tools:run_ipython_cell",
+    summary="Invoke a cell in a stateful IPython (Jupyter) kernel",
+    response_description="NDJSON stream of observations (stdout, stderr, result)",
+    status_code=200, # Return 200 OK immediately
+    openapi_extra=_body_schema(RunIPythonCellRequest),
+)
+async def run_ipython_cell(http_request: Request) -> Response:
+    """
+    Runs the cell on the EXECUTOR pool so a long cell never blocks the event loop
+    (health checks, other sandboxes). Cells of the same sandbox are serialized
+    by an asyncio lock taken here, before a worker thread is claimed.
+    """
+    request = await _parse_body(http_request, RunIPythonCellRequest)
+    # (validated once in lifespan, so it is always set here)
+    sandbox_id = SANDBOX_ID
+    action_id = request.action_id
+
+    logger.info("[AGENT] Received IPython cell request. ActionID: %s, SandboxID: %s. Attempting to acquire lock...", action_id, sandbox_id)
+
+    # --- 关键：同一 sandbox 的其他 IPython 请求会在此等待 (不占用 EXECUTOR 线程) ---
+    async with ipython_lock:
+        logger.info("[AGENT] Lock acquired for SandboxID: %s, ActionID: %s. Processing request...", sandbox_id, action_id)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(EXECUTOR, _run_ipython_cell_sync, request)
+        finally:
+            logger.info("[AGENT] Releasing lock for SandboxID: %s, ActionID: %s.", sandbox_id, action_id)
+
+
+async def _stream_pipe(
+    pipe: asyncio.StreamReader,
+    name: str,
+    dispatcher: ObservationDispatcher,
+    action_id: Optional[str],
+    tail: Optional["collections.deque[str]"] = None,
+) -> int:
+    """
+    Forwards one subprocess pipe to the runtime line by line as it is read.
+    A line longer than the pipe's limit is forwarded in limit-sized pieces.
+    Returns the number of bytes read; only the last lines are kept (in tail).
+    """
+    nbytes = 0
+    eof = False
+    while not eof:
+        try:
+            raw = await pipe.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # Last line without a trailing newline
+            raw, eof = e.partial, True
+        except asyncio.LimitOverrunError as e:
+            raw = await pipe.readexactly(e.consumed)
+        nbytes += len(raw)
+        line = raw.decode(errors="replace").rstrip("\n")
+        if not line:
+            continue
+        if tail is not None:
+            tail.append(line)
+        if action_id:
+            await dispatcher.asend({
+                "observation_type": "stream", # Correct key
+                "action_id": action_id,
+                "stream": name,
+                "line": line
+            })
+    return nbytes
+
+
+# Longest single output line read from a shell command, and how many trailing
+# stderr lines are kept for the result's "error" field
+SHELL_LINE_LIMIT = 1024 * 1024
+SHELL_STDERR_TAIL_LINES = 100
+
+# Anything that only /bin/sh can interpret: operators, expansions, globs,
+# comments, assignments, escapes, multi-line scripts
+_SHELL_METACHARS = frozenset("|&;<>()$`\\\"'*?[]{}~#=!\n")
+# First words that are shell builtins/keywords. This includes builtins that
+# also exist as programs on PATH (echo, printf, test, ...), whose behaviour can
+# differ from /bin/sh's (e.g. "echo -e"), so a command never changes meaning
+_SHELL_WORDS = frozenset((
+    ".", ":", "alias", "break", "cd", "command", "continue", "eval", "exec", "exit",
+    "export", "hash", "readonly", "return", "set", "shift", "source", "trap", "type",
+    "ulimit", "umask", "unalias", "unset", "wait", "if", "for", "while", "until", "case",
+    "echo", "printf", "test", "[", "pwd", "kill", "true", "false", "read", "getopts",
+    "times", "jobs", "fg", "bg", "local",
+))
+
+
+async def _spawn_command(command: str) -> asyncio.subprocess.Process:
+    """
+    Starts command, exec'ing it directly when it is a plain argv (saving the
+    fork+exec of /bin/sh) and falling back to the shell otherwise.
+    """
+    kwargs: dict[str, Any] = dict(
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=SHELL_LINE_LIMIT,
+        # Own process group, so an aborted command can be killed with its children
+        start_new_session=True,
+    )
+    if _SHELL_METACHARS.isdisjoint(command):
+        argv = command.split()
+        if argv and argv[0] not in _SHELL_WORDS:
+            try:
+                return await asyncio.create_subprocess_exec(*argv, **kwargs)
+            except OSError:
+                # Let the shell produce its usual "not found" / 126 / 127 outcome
+                pass
+    return await asyncio.create_subprocess_shell(command, **kwargs)
+
 @app.post(
     "/tools:run_shell_command",
     summary="Invoke a shell command.",
     response_description="NDJSON stream of observations (stdout, stderr, result)",
     status_code=200, # Return 200 OK immediately
+    openapi_extra=_body_schema(RunShellCommandRequest),
 )
-def run_shell_command(request: RunShellCommandRequest):
+async def run_shell_command(http_request: Request) -> Response:
     """
     Execute a shell command. Observations are pushed asynchronously
-    to the RUNTIME_OBSERVATION_URL.
-    Returns an immediate 200 OK if the request is accepted.
+    to the RUNTIME_OBSERVATION_URL as each output line is read, so memory
+    stays bounded to one line and the first observation goes out as soon as
+    the command prints it.
+    Returns 200 OK once the command has exited.
     """
+    request = await _parse_body(http_request, RunShellCommandRequest)
     # --- Use correct action_id from request ---
     action_id = request.action_id
      # ---
 
-    sandbox_id = os.environ.get('SANDBOX_ID')
-    runtime_observation_url = os.environ.get('RUNTIME_OBSERVATION_URL')
+    sandbox_id = SANDBOX_ID
+    runtime_observation_url = RUNTIME_OBSERVATION_URL
 
-    logger.info(f"[AGENT] Received shell command request: '{request.command}'. ActionID: {action_id}, SandboxID: {sandbox_id}")
+    logger.info("[AGENT] Received shell command request: '%s'. ActionID: %s, SandboxID: %s", request.command, action_id, sandbox_id)
 
     if not runtime_observation_url:
         logger.error("[AGENT] RUNTIME_OBSERVATION_URL environment variable not set. Cannot send observations.")
@@ -269,59 +683,38 @@ def run_shell_command(request: RunShellCommandRequest):
 
     exit_code = -1
     error_output = None
+    dispatcher = ObservationDispatcher(runtime_observation_url, action_id)
+    process: Optional[asyncio.subprocess.Process] = None
+    readers: list[asyncio.Task] = []
 
     try:
-        process = subprocess.Popen(
-            request.command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
+        process = await _spawn_command(request.command)
+        assert process.stdout is not None and process.stderr is not None
 
-        stdout, stderr = process.communicate()
-        exit_code = process.returncode
+        stderr_tail: collections.deque[str] = collections.deque(maxlen=SHELL_STDERR_TAIL_LINES)
+        readers = [
+            asyncio.create_task(_stream_pipe(process.stdout, "stdout", dispatcher, action_id)),
+            asyncio.create_task(_stream_pipe(process.stderr, "stderr", dispatcher, action_id, stderr_tail)),
+        ]
+        stdout_len, stderr_len = await asyncio.gather(*readers)
+        exit_code = await process.wait()
 
-        logger.info(f"[AGENT] Shell command finished. ActionID: {action_id}. ExitCode: {exit_code}. Stdout: {len(stdout)} chars. Stderr: {len(stderr)} chars.")
+        logger.info("[AGENT] Shell command finished. ActionID: %s. ExitCode: %s. Stdout: %s bytes. Stderr: %s bytes.", action_id, exit_code, stdout_len, stderr_len)
 
-        # --- Send Observations ---
+        if exit_code != 0 and stderr_tail:
+            error_output = "\n".join(stderr_tail).strip()
+
+        # --- Send final result observation; it is queued behind every stream line ---
         if runtime_observation_url and action_id:
-            # Send stdout lines
-            if stdout:
-                stdout_lines = stdout.rstrip('\n').split('\n')
-                for line in stdout_lines:
-                    if line:
-                        send_observation(runtime_observation_url, {
-                            "observation_type": "stream", # Correct key
-                            "action_id": action_id,
-                            "stream": "stdout",
-                            "line": line
-                        })
-
-            # Send stderr lines
-            if stderr:
-                stderr_lines = stderr.rstrip('\n').split('\n')
-                if exit_code != 0:
-                    error_output = stderr.strip()
-
-                for line in stderr_lines:
-                    if line:
-                         send_observation(runtime_observation_url, {
-                            "observation_type": "stream", # Correct key
-                            "action_id": action_id,
-                            "stream": "stderr",
-                            "line": line
-                        })
-
-            # Send final result observation
-            send_observation(runtime_observation_url, {
+            await dispatcher.asend({
                 "observation_type": "result", # Correct key
                 "action_id": action_id,
                 "exit_code": exit_code,
                 "error": error_output,
             })
         else:
-             logger.warning(f"[AGENT] Cannot send observations: URL={runtime_observation_url}, action_id={action_id}")
+             logger.warning("[AGENT] Cannot send observations: URL=%s, action_id=%s", runtime_observation_url, action_id)
+        await dispatcher.aclose()
 
         return Response(status_code=200)
 
@@ -329,70 +722,71 @@ def run_shell_command(request: RunShellCommandRequest):
         exit_code = -1
         error_msg = f"Internal agent error during shell execution: {e}"
         tb_str = traceback.format_exc()
-        logger.error(f"[AGENT] {error_msg}. ActionID: {action_id}\n{tb_str}")
+        logger.error("[AGENT] %s. ActionID: %s\n%s", error_msg, action_id, tb_str)
+
+        # Stop the other reader before the result is queued, so no stream
+        # line can follow it, and don't leave the command running
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        if process is not None and process.returncode is None:
+            # The whole group, so no grandchild keeps the pipes (and wait()) open
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
 
         if runtime_observation_url and action_id:
-             send_observation(runtime_observation_url, {
+             await dispatcher.asend({
                 "observation_type": "result", # Correct key
                 "action_id": action_id,
                 "exit_code": exit_code,
                 "error": error_msg
             })
+        await dispatcher.aclose()
 
         raise HTTPException(status_code=500, detail=error_msg)
 
 
-def send_observation(url: str, data: dict):
+async def send_observations_async(url: Optional[str], action_id: Optional[str], batch: list[bytes]) -> None:
     """
-    Send observation data to the runtime service. Logs errors.
+    Send a batch of observations to the runtime service over the shared AsyncClient.
+    A single observation is posted as JSON, several as one NDJSON body.
+    Logs errors.
     Args:
-        url: The URL to send the observation to.
-        data: The observation data dictionary to send as JSON.
-            Must include "observation_type" and "action_id".
+        url: The URL to send the observations to.
+        action_id: The action the observations belong to, for logging.
+        batch: JSON-encoded observations, all for the same action.
     """
-    if not url:
-        # Log once if URL is missing? Or rely on caller's check?
-        # logger.error("[AGENT] send_observation called with no URL.")
+    if not url or not batch:
         return # Cannot send without URL
 
-    action_id = data.get("action_id", "UNKNOWN") # Get action_id for logging
-    obs_type = data.get("observation_type", "UNKNOWN") # Get type for logging
-
-    # --- 确保添加 Timestamp ---
-    if "timestamp" not in data:
-        data["timestamp"] = datetime.now(timezone.utc).isoformat()
-    # ---
+    if len(batch) == 1:
+        body = batch[0]
+        content_type = "application/json"
+    else:
+        body = b"\n".join(batch) + b"\n"
+        content_type = "application/x-ndjson"
 
-    # --- 添加详细的 Debug 日志 (包含 action_id 和 observation_type) ---
-    try:
-        # 使用 ensure_ascii=False 以便日志中能正确显示非 ASCII 字符
-        data_str = json.dumps(data, ensure_ascii=False)
-    except Exception as dump_err:
-        # 如果数据无法序列化为 JSON（理论上不应发生），记录错误
-        logger.error(f"[AGENT SENDING] Failed to dump observation data to JSON string. ActionID: {action_id}, Type: {obs_type}, Error: {dump_err}")
-        data_str = f"RAW_DATA_ERROR: {data}" # 提供原始数据快照
-    # 打印即将发送的完整数据
-    logger.debug(f"[AGENT SENDING] URL: {url}, ActionID: {action_id}, Type: {obs_type}, Data: {data_str}")
+    # --- 添加详细的 Debug 日志 (包含 action_id) ---
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[AGENT SENDING] URL: %s, ActionID: %s, Count: %d, Data: %s", url, action_id, len(batch), body.decode())
     # ---
 
     try:
-        response = requests.post(
-            url,
-            json=data, # requests 会自动设置 Content-Type: application/json
-            headers={"Content-Type": "application/json"}, # 明确设置以防万一
-            timeout=10 # 设置请求超时
-        )
+        response = await app.state.http.post(url, content=body, headers={"Content-Type": content_type})
         response.raise_for_status() # 对 4xx/5xx 状态码抛出异常
         # 发送成功后可以只记录 Info 或 Debug 级别的日志
-        logger.debug(f"[AGENT] Observation sent successfully. ActionID: {action_id}, Type: {obs_type}, Status: {response.status_code}")
+        logger.debug("[AGENT] Observations sent successfully. ActionID: %s, Count: %d, Status: %s", action_id, len(batch), response.status_code)
 
-    except requests.exceptions.Timeout:
-        logger.warning(f"[AGENT] Timeout sending observation to runtime. ActionID: {action_id}, Type: {obs_type}, URL: {url}")
-    except requests.exceptions.RequestException as e:
-        logger.warning(f"[AGENT] Failed to send observation to runtime. ActionID: {action_id}, Type: {obs_type}, URL: {url}, Error: {e}")
+    except httpx.TimeoutException:
+        logger.warning("[AGENT] Timeout sending observations to runtime. ActionID: %s, Count: %s, URL: %s", action_id, len(batch), url)
+    except httpx.HTTPError as e:
+        logger.warning("[AGENT] Failed to send observations to runtime. ActionID: %s, Count: %s, URL: %s, Error: %s", action_id, len(batch), url, e)
     except Exception as e:
         # 捕获其他潜在错误
-         logger.error(f"[AGENT] Unexpected error in send_observation. ActionID: {action_id}, Type: {obs_type}, Error: {e}", exc_info=True)
+         logger.error("[AGENT] Unexpected error in send_observations. ActionID: %s, Count: %s, Error: %s", action_id, len(batch), e, exc_info=True)
 
 if __name__ == "__main__":
     import uvicorn
@@ -400,11 +794,11 @@ if __name__ == "__main__":
     # Use environment variables for configuration or defaults
     port = int(os.environ.get("MENTIS_EXECUTOR_PORT", 8000)) # Use a more specific env var name
     host = os.environ.get("MENTIS_EXECUTOR_HOST", "0.0.0.0") # Use a more specific env var name
-    log_level = os.environ.get("MENTIS_EXECUTOR_LOG_LEVEL", "debug").lower() # Allow configuring log level
-
-    # Reconfigure logging based on environment variable
-    logging.basicConfig(level=log_level.upper(), # Set level based on env var
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    logger.info(f"[AGENT] Starting Mentis Executor on {host}:{port} with log level {log_level}")
-    uvicorn.run(app, host=host, port=port, log_level=log_level) # Pass log_level to uvicorn
\ No newline at end of file
+    log_level = LOG_LEVEL # Logging itself was configured at the top of the module
+
+    logger.info("[AGENT] Starting Mentis Executor on %s:%s with log level %s", host, port, log_level)
+    # uvloop + httptools (both shipped with uvicorn[standard]) replace the default
+    # asyncio loop and h11 parser
+    # One access-log line per action is only worth its cost when debugging
+    uvicorn.run(app, host=host, port=port, loop="uvloop", http="httptools", log_level=log_level, # Pass log_level to uvicorn
+                access_log=log_level == "debug")
\ No newline at end of file